@@ -1,10 +1,17 @@
 import os
-import shutil
 from typing import Iterator
 
 from ..context import Context
 from ..package import Package
-from ..util import apply_patch, download, run
+from ..util import (
+    apply_git_patches,
+    apply_patch,
+    cached_exists,
+    clear_exists_cache,
+    download_and_extract,
+    git_mirror,
+    run,
+)
 from .gnu import AutoMake
 
 
@@ -22,48 +29,49 @@ class LibUnwind(Package):
         return "libunwind-" + self.version
 
     def is_fetched(self, ctx: Context) -> bool:
-        return os.path.exists("src")
+        return cached_exists(self.path(ctx, "src"))
 
     def fetch(self, ctx: Context) -> None:
         urlbase = "http://download.savannah.gnu.org/releases/libunwind/"
-        dirname = self.ident()
-        tarname = dirname + ".tar.gz"
-        download(ctx, urlbase + tarname)
-        run(ctx, ["tar", "-xf", tarname])
-        shutil.move(dirname, "src")
-        os.remove(tarname)
+        tarname = self.ident() + ".tar.gz"
+        download_and_extract(ctx, urlbase + tarname, "src")
+        clear_exists_cache()
 
     def is_built(self, ctx: Context) -> bool:
-        return os.path.exists("obj/src/.libs/libunwind.so")
+        return cached_exists(self.path(ctx, "obj/src/.libs/libunwind.so"))
 
     def _apply_patches(self, ctx: Context) -> None:
-        os.chdir(self.path(ctx, "src"))
+        src_dir = self.path(ctx, "src")
         config_root = os.path.dirname(os.path.abspath(__file__))
         for path in self.patches:
             if "/" not in path:
                 path = f"{config_root}/{path}.patch"
-            if apply_patch(ctx, path, 1):
+            if apply_patch(ctx, path, 1, cwd=src_dir):
                 ctx.log.warning(f"applied patch {path} to libunwind directory")
-        os.chdir(self.path(ctx))
 
     def build(self, ctx: Context) -> None:
         self._apply_patches(ctx)
 
-        os.makedirs("obj", exist_ok=True)
-        os.chdir("obj")
-        if not os.path.exists("Makefile"):
-            run(ctx, ["../src/configure", "--prefix=" + self.path(ctx, "install")])
-        run(ctx, f"make -j{ctx.jobs}")
+        obj_dir = self.path(ctx, "obj")
+        os.makedirs(obj_dir, exist_ok=True)
+        if not os.path.exists(os.path.join(obj_dir, "Makefile")):
+            run(ctx, ["../src/configure", "--prefix=" + self.path(ctx, "install")], cwd=obj_dir)
+        # Cap by system load and serialize output per recursive make, so -j
+        # keeps scaling instead of thrashing or stalling on interleaved output
+        run(ctx, f"make -j{ctx.jobs} -l{ctx.jobs} --output-sync=recurse", cwd=obj_dir)
+        clear_exists_cache()
 
     def is_installed(self, ctx: Context) -> bool:
-        return os.path.exists("install/lib/libunwind.so")
+        return cached_exists(self.path(ctx, "install/lib/libunwind.so"))
 
     def install(self, ctx: Context) -> None:
-        os.chdir("obj")
-        run(ctx, "make install")
+        run(ctx, "make install", cwd=self.path(ctx, "obj"))
+        clear_exists_cache()
 
     def configure(self, ctx: Context) -> None:
-        ctx.ldflags += ["-L" + self.path(ctx, "install/lib"), "-lunwind"]
+        # Skip flags that are already set: chained configure calls from multiple
+        # dependents would otherwise grow the link command on every invocation
+        ctx.add_flags(["-L" + self.path(ctx, "install/lib"), "-lunwind"], ld=True, dups=False)
 
 
 class Gperftools(Package):
@@ -87,37 +95,55 @@ class Gperftools(Package):
         yield self.libunwind
 
     def is_fetched(self, ctx: Context) -> bool:
-        return os.path.exists("src")
+        return cached_exists(self.path(ctx, "src"))
 
     def fetch(self, ctx: Context) -> None:
-        run(ctx, "git clone https://github.com/gperftools/gperftools.git src")
-        os.chdir("src")
-        run(ctx, ["git", "checkout", self.commit])
+        # Blobless clone: only fetch file contents for the commit we check out,
+        # not for the entire history; reuse objects from a local mirror so that
+        # repeated fetches (e.g. after --force-rebuild) don't hit the network
+        url = "https://github.com/gperftools/gperftools.git"
+        mirror = git_mirror(ctx, url)
+        run(
+            ctx,
+            [
+                "git",
+                "clone",
+                "--filter=blob:none",
+                "--no-checkout",
+                "--reference-if-able",
+                mirror,
+                "--dissociate",
+                url,
+                "src",
+            ],
+        )
+        run(ctx, ["git", "checkout", self.commit], cwd=self.path(ctx, "src"))
+        clear_exists_cache()
 
     def is_built(self, ctx: Context) -> bool:
-        return os.path.exists("obj/.libs/libtcmalloc.so")
+        return cached_exists(self.path(ctx, "obj/.libs/libtcmalloc.so"))
 
     def _apply_patches(self, ctx: Context) -> None:
-        os.chdir(self.path(ctx, "src"))
+        # The source tree is a git checkout, so all patches go in one git apply batch
+        src_dir = self.path(ctx, "src")
         config_root = os.path.dirname(os.path.abspath(__file__))
-        for path in self.patches:
-            if "/" not in path:
-                path = f"{config_root}/{path}.patch"
-            if apply_patch(ctx, path, 1):
-                ctx.log.warning(f"applied patch {path} to gperftools directory")
-        os.chdir(self.path(ctx))
+        paths = [path if "/" in path else f"{config_root}/{path}.patch" for path in self.patches]
+        if apply_git_patches(ctx, paths, 1, src_dir):
+            ctx.log.warning(f"applied patches {paths} to gperftools directory")
 
     def build(self, ctx: Context) -> None:
         self._apply_patches(ctx)
 
-        if not os.path.exists("src/configure") or not os.path.exists("src/INSTALL"):
-            os.chdir("src")
-            run(ctx, "autoreconf -vfi")
-            self.goto_rootdir(ctx)
+        src_dir = self.path(ctx, "src")
+        obj_dir = self.path(ctx, "obj")
+
+        if not os.path.exists(os.path.join(src_dir, "configure")) or not os.path.exists(
+            os.path.join(src_dir, "INSTALL")
+        ):
+            run(ctx, "autoreconf -vfi", cwd=src_dir)
 
-        os.makedirs("obj", exist_ok=True)
-        os.chdir("obj")
-        if not os.path.exists("Makefile"):
+        os.makedirs(obj_dir, exist_ok=True)
+        if not os.path.exists(os.path.join(obj_dir, "Makefile")):
             prefix = self.path(ctx, "install")
             run(
                 ctx,
@@ -127,15 +153,17 @@ class Gperftools(Package):
                     "LDFLAGS=-L" + self.libunwind.path(ctx, "install/lib"),
                     "--prefix=" + prefix,
                 ],
+                cwd=obj_dir,
             )
-        run(ctx, f"make -j{ctx.jobs}")
+        run(ctx, f"make -j{ctx.jobs} -l{ctx.jobs} --output-sync=recurse", cwd=obj_dir)
+        clear_exists_cache()
 
     def is_installed(self, ctx: Context) -> bool:
-        return os.path.exists("install/lib/libtcmalloc.so")
+        return cached_exists(self.path(ctx, "install/lib/libtcmalloc.so"))
 
     def install(self, ctx: Context) -> None:
-        os.chdir("obj")
-        run(ctx, "make install")
+        run(ctx, "make install", cwd=self.path(ctx, "obj"))
+        clear_exists_cache()
 
     def configure(self, ctx: Context) -> None:
         """
@@ -143,13 +171,19 @@ class Gperftools(Package):
         ``configure`` method of an instance.
 
         Sets the necessary ``-I/-L/-l`` flags, and additionally adds
-        ``-fno-builtin-{malloc,calloc,realloc,free}`` to CFLAGS.
+        ``-fno-builtin-{malloc,calloc,realloc,free}`` to CFLAGS. Flags that
+        are already present are not added again, so repeated configure calls
+        from multiple dependents don't grow the command lines.
 
         :param ctx: the configuration context
         """
         self.libunwind.configure(ctx)
+        install_dir = self.path(ctx, "install")
         cflags = ["-fno-builtin-" + fn for fn in ("malloc", "calloc", "realloc", "free")]
-        cflags += ["-I", self.path(ctx, "install/include/gperftools")]
-        ctx.cflags += cflags
-        ctx.cxxflags += cflags
-        ctx.ldflags += ["-L" + self.path(ctx, "install/lib"), "-ltcmalloc", "-lpthread"]
+        cflags += ["-I" + os.path.join(install_dir, "include/gperftools")]
+        ctx.add_flags(cflags, cc=True, cxx=True, dups=False)
+        ctx.add_flags(
+            ["-L" + os.path.join(install_dir, "lib"), "-ltcmalloc", "-lpthread"],
+            ld=True,
+            dups=False,
+        )
@@ -1,6 +1,7 @@
-from itertools import chain
+import functools
 import itertools
-import logging
+import json
+import hashlib
 import os
 import shutil
 import subprocess
@@ -13,16 +14,10 @@ from urllib import request
 from collections.abc import Iterable, Iterator
 from dataclasses import dataclass
 from pathlib import Path
-from typing import NamedTuple
-from requests import patch
-from sympy import Q
 
 from ...context import Context
 from ...package import Package
-from ...util import FatalError, apply_patch, download, run, untar
-from ..cmake import CMake
-from ..gnu import AutoMake, Bash, BinUtils, CoreUtils, Make
-from ..ninja import Ninja
+from ...util import apply_git_patches, git_mirror, run
 
 
 @dataclass(repr=False, eq=True, order=True, frozen=True, slots=True)
@@ -44,6 +39,28 @@ class Version:
         return f"{self.major}.{self.minor}.{self.patch}"
 
 
+@functools.lru_cache(maxsize=None)
+def _llvmConfigVersion(conf: Path) -> Version | None:
+    """Run `llvm-config --version` for the given binary once and cache the reported version"""
+    try:
+        _p = subprocess.run([conf, "--version"], capture_output=True, text=True)
+        return Version.parse(_p.stdout.strip())
+    except:
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def _patchHash(patchfile: Path) -> str:
+    """Hash a patch file's contents once per run and cache it for repeated is_built probes"""
+    return hashlib.sha256(patchfile.read_bytes()).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def _llvmConfigPath(conf: Path, flag: str) -> Path:
+    """Query a path (e.g. --bindir/--libdir) from the given llvm-config binary once and cache it"""
+    return Path(subprocess.run([conf, flag], capture_output=True, text=True).stdout.strip())
+
+
 def getGlobalLLVM(version: Version | None = None) -> Path | None:
     """Try to get a llvm-config binary for the requested version from the system ($PATH)"""
 
@@ -52,17 +69,13 @@ def getGlobalLLVM(version: Version | None = None) -> Path | None:
         conf_bin = shutil.which("llvm-config")
         return Path(conf_bin) if conf_bin is not None else None
 
-    # Helper function to verify the version reported by llvm-config
+    # Helper function to verify the version reported by llvm-config; probes for a given binary
+    # are cached so repeated package instantiations don't fork llvm-config again
     def _checkVersion(_bin: Path, _v: Version | None = None) -> Version | None:
-        try:
-            _p = subprocess.run([_bin, "--version"], capture_output=True, text=True)
-
-            # Check the version iff it was given; otherwise return the reported version
-            if _v is None:
-                return Version.parse(_p.stdout.strip())
-            return _v if _v == Version.parse(_p.stdout.strip()) else None
-        except:
-            return None
+        reported = _llvmConfigVersion(_bin)
+        if _v is None or reported is None:
+            return reported
+        return _v if _v == reported else None
 
     # Try to find a versioned llvm-config binary in the system (if any) for the requested version
     v_bin = shutil.which(f"llvm-config-{version.major}")
@@ -83,7 +96,7 @@ def llvmHasBin(conf: Path, bin: str) -> bool:
     """Check if the given llvm-config instance's bindir contains the given program"""
     if not conf.is_file() or not bin:
         return False
-    bindir = Path(subprocess.run([conf, "--bindir"], capture_output=True, text=True).stdout.strip())
+    bindir = _llvmConfigPath(conf, "--bindir")
     return any(bindir.glob(bin)) if bindir.is_dir() else False
 
 
@@ -91,7 +104,7 @@ def llvmHasLib(conf: Path, lib: str) -> bool:
     """Check if the given llvm-config instance's libdir recursively contains the given library"""
     if not conf.is_file() or not lib:
         return False
-    libdir = Path(subprocess.run([conf, "--libdir"], capture_output=True, text=True).stdout.strip())
+    libdir = _llvmConfigPath(conf, "--libdir")
     return any(libdir.rglob(lib)) if libdir.is_dir() else False
 
 
@@ -162,6 +175,11 @@ class LLVM(Package):
         return self.name
 
     def dependencies(self) -> Iterator[Package]:
+        # Imported here rather than at module level: each of these pulls in its own
+        # import chain, which CLI invocations that never build LLVM shouldn't pay for
+        from ..cmake import CMake
+        from ..gnu import AutoMake, Bash, BinUtils, CoreUtils, Make
+
         if self.llvm_config is not None:
             yield from []
         else:
@@ -196,6 +214,8 @@ class LLVM(Package):
         force_local: bool = False,
         allow_bins: bool = True,
         commit: str | None = None,
+        assertions: bool = False,
+        lto: str | None = "thin",
         projects: Iterable[str] = {"clang", "lld"},
         runtimes: Iterable[str] = {"compiler-rt"},
         build_flags: Iterable[str] = [
@@ -229,6 +249,13 @@ class LLVM(Package):
             Allow using binary releases of the given LLVM version if they exist
         :param str | None commit:
             Build LLVM from this specific commit/hash/tag/release, defaults to "llvmorg-<version>"
+        :param bool assertions:
+            Enable LLVM assertions; these roughly double the runtime cost of the built clang for
+            every downstream compilation, so they are opt-in, defaults to False
+        :param str | None lto:
+            Self-host the built clang with (Thin)LTO ("thin" or "full") for a measurably faster
+            compiler; only applied for Release builds when the host toolchain supports it
+            (clang + ld.lld), defaults to "thin"
         :param Iterable[str] projects:
             List of projects to build
         :param Iterable[str] runtimes:
@@ -248,11 +275,25 @@ class LLVM(Package):
         self.force_local = force_local
         self.allow_bins = allow_bins
         self.commit = commit if commit is not None else f"llvmorg-{self.version}"
+        self.lto = lto
         self.projects = set(projects)
         self.runtimes = set(runtimes)
         self.build_flags = set(build_flags)
         self.patches = set(patches)
 
+        # Don't compile tests/examples/benchmarks; nothing in the infra consumes them and
+        # they account for thousands of object files. Assertions are opt-in: every user
+        # compilation with the built clang pays for them. Explicit user flags take precedence
+        for default_flag in (
+            f"-DLLVM_ENABLE_ASSERTIONS={'On' if assertions else 'Off'}",
+            "-DLLVM_INCLUDE_TESTS=OFF",
+            "-DLLVM_INCLUDE_EXAMPLES=OFF",
+            "-DLLVM_INCLUDE_BENCHMARKS=OFF",
+            "-DCLANG_INCLUDE_TESTS=OFF",
+        ):
+            if not any(flag.split("=", 1)[0] == default_flag.split("=", 1)[0] for flag in self.build_flags):
+                self.build_flags.add(default_flag)
+
         # Some sanity checks
         if self.llvm_config is not None and force_local:
             raise ValueError("Providing llvm-config not compatible with forcing local builds/build flags/patches")
@@ -278,22 +319,31 @@ class LLVM(Package):
     def is_fetched(self, ctx: Context) -> bool:
         if self.llvm_config is not None:
             return True
-        return any(self.root_dir(ctx).iterdir()) if self.root_dir(ctx).is_dir() else False
+        root_dir = self.root_dir(ctx)
+        return any(root_dir.iterdir()) if root_dir.is_dir() else False
 
     def is_built(self, ctx: Context) -> bool:
         if self.llvm_config is not None:
             return True
-        return any(self.root_dir(ctx, "build").iterdir()) if self.root_dir(ctx, "build").is_dir() else False
+        build_dir = self.root_dir(ctx, "build")
+        if not build_dir.is_dir() or not any(build_dir.iterdir()):
+            return False
+        # Only reuse a build tree that was produced by the current configuration; a
+        # missing or stale fingerprint (changed patches/flags/commit) forces a rebuild
+        fingerprint = build_dir / ".infra-build-fingerprint"
+        return fingerprint.is_file() and fingerprint.read_text().strip() == self._fingerprint(ctx)
 
     def is_installed(self, ctx: Context) -> bool:
         if self.llvm_config is not None:
             return True
-        return any(self.root_dir(ctx, "install").iterdir()) if self.root_dir(ctx, "install").is_dir() else False
+        install_dir = self.root_dir(ctx, "install")
+        return any(install_dir.iterdir()) if install_dir.is_dir() else False
 
     def is_clean(self, ctx: Context) -> bool:
         if self.llvm_config is not None:
             return True
-        return not any(self.root_dir(ctx).iterdir()) if self.root_dir(ctx).is_dir() else True
+        root_dir = self.root_dir(ctx)
+        return not any(root_dir.iterdir()) if root_dir.is_dir() else True
 
     def __get_bins(self, ctx: Context) -> Path | None:
         urls: list[str] = []
@@ -389,56 +439,145 @@ class LLVM(Package):
                 return
 
         ctx.log.info(f"Fetching LLVM {self.version} sources...")
-        run(
-            ctx,
-            [
-                "git",
-                "clone",
-                "--depth",
-                "1",
-                "--branch",
-                f"llvmorg-{self.version}",
-                "https://github.com/llvm/llvm-project.git",
-                self.path(ctx),
-            ],
-            teeout=True,
-        )
+        url = "https://github.com/llvm/llvm-project.git"
+        if self.commit == f"llvmorg-{self.version}":
+            # Default release tag: a depth-1 clone of the tag is the cheapest option
+            run(
+                ctx,
+                [
+                    "git",
+                    "clone",
+                    "--depth",
+                    "1",
+                    "--branch",
+                    f"llvmorg-{self.version}",
+                    url,
+                    self.path(ctx),
+                ],
+                teeout=True,
+            )
+        else:
+            # Arbitrary commit: add a detached worktree backed by the shared local mirror
+            # instead of cloning, so all commit variants share one object store and each
+            # variant only costs its own working tree. A sparse checkout then only
+            # materialises the subprojects that LLVM_ENABLE_PROJECTS/LLVM_ENABLE_RUNTIMES
+            # will actually consume
+            src = self.path(ctx)
+            mirror = git_mirror(ctx, url)
+            run(ctx, ["git", "-C", mirror, "worktree", "prune"])
+            run(
+                ctx,
+                [
+                    "git",
+                    "-C",
+                    mirror,
+                    "worktree",
+                    "add",
+                    "--detach",
+                    "--no-checkout",
+                    src,
+                    self.commit,
+                ],
+                teeout=True,
+            )
+            run(ctx, ["git", "-C", src, "sparse-checkout", "init", "--cone"])
+            run(
+                ctx,
+                [
+                    "git",
+                    "-C",
+                    src,
+                    "sparse-checkout",
+                    "set",
+                    "llvm",
+                    "cmake",
+                    "third-party",
+                    # The top-level runtimes/ harness bootstraps every
+                    # -DLLVM_ENABLE_RUNTIMES build as an external project
+                    "runtimes",
+                    *sorted(self.projects | self.runtimes),
+                ],
+            )
+            run(ctx, ["git", "-C", src, "checkout", self.commit], teeout=True)
         ctx.log.info(f"Cloned LLVM {self.version} sources into {self.root_dir(ctx)}")
 
-    def apply_patches(self, ctx: Context) -> None:
+    def _resolve_patch(self, ctx: Context, patch: Path | str | tuple[str, str]) -> tuple[Path, Path]:
         """
-        Apply the patches specified in self.patches. For supported formats for this iterable, see
-        this class' docstring.
+        Resolve a patch specification from self.patches (see this class' docstring for the
+        supported formats) into a (workdir, patchfile) pair of absolute paths.
 
         :param Context ctx: the configuration context
+        :param patch: the patch specification to resolve
         """
-        for patch in self.patches:
-            ctx.log.debug(f"Parsing and applying patch: {patch}")
-            self.goto_rootdir(ctx)
+        if isinstance(patch, tuple):
+            # The working directory for applying the patch can be specified in the first element
+            workdir = Path(self.path(ctx, patch[0]))
+            patch = patch[1]
+        else:
+            # Just use the package's base directory as the working directory
+            workdir = Path(self.path(ctx))
 
-            # Get the working directory to use and the patchfile to apply
-            if isinstance(patch, tuple):
-                # The working directory for applying the patch can be specified in the first element
-                workdir = Path(self.path(ctx, patch[0]))
+        # Get the patch file to use (either from an absolute path or a built-in patch)
+        if Path(patch).is_absolute():
+            patchfile = Path(patch)
+        else:
+            patchfile = Path(__file__).absolute().parent.joinpath(patch)
 
-                # The second element picks the (possibly absolute path or to a built-in) patch file
-                if Path(patch[1]).is_absolute():
-                    patchfile = Path(patch[1])
-                else:
-                    patchfile = Path(__file__).absolute().parent.joinpath(patch[1])
+        return workdir, patchfile
+
+    def _fingerprint(self, ctx: Context) -> str:
+        """
+        Hash of everything that determines the output of a source build: version, commit,
+        enabled projects/runtimes, build flags, and the contents of all resolved patches.
+        Stored in the build tree so :func:`is_built` can tell a reusable build apart from
+        a stale one.
+
+        :param Context ctx: the configuration context
+        """
+        patch_hashes = []
+        for patch in sorted(self.patches, key=str):
+            _, patchfile = self._resolve_patch(ctx, patch)
+            if patchfile.is_file():
+                patch_hashes.append(_patchHash(patchfile))
             else:
-                # Just use the package's base directory as the working directory
-                workdir = Path(self.path(ctx))
+                # An unresolvable spec must not crash the is_built probe; it yields a
+                # fingerprint that never matches a recorded one, so the build is retried
+                # and the clear "patch file not found" error surfaces at patch-apply time
+                patch_hashes.append(f"unresolved:{patchfile.name}")
+
+        config = {
+            "version": repr(self.version),
+            "commit": self.commit,
+            "lto": self.lto,
+            "projects": sorted(self.projects),
+            "runtimes": sorted(self.runtimes),
+            "flags": sorted(self.build_flags),
+            "patches": patch_hashes,
+        }
+        return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
 
-                # Get the patch file to use (either from an absolute path or a built-in patch)
-                if Path(patch).is_absolute():
-                    patchfile = Path(patch)
-                else:
-                    patchfile = Path(__file__).absolute().parent.joinpath(patch)
+    def apply_patches(self, ctx: Context) -> None:
+        """
+        Apply the patches specified in self.patches. For supported formats for this iterable, see
+        this class' docstring.
+
+        Since the source tree is always a git checkout, all patches sharing a working directory
+        are applied with a single ``git apply`` invocation rather than one ``patch`` process
+        (and full tree scan) per file.
+
+        :param Context ctx: the configuration context
+        """
+        by_workdir: dict[tuple[Path, int], list[Path]] = {}
+        for patch in self.patches:
+            ctx.log.debug(f"Parsing patch: {patch}")
+            workdir, patchfile = self._resolve_patch(ctx, patch)
+            # Git-style diffs (all builtin patches) carry a/ b/ path prefixes and need one
+            # more leading component stripped than plain diffs
+            strip = 1 if "--- a/" in patchfile.read_text(errors="replace") else 0
+            by_workdir.setdefault((workdir, strip), []).append(patchfile)
 
-            # Actually apply the patch
-            os.chdir(workdir)
-            apply_patch(ctx, str(patchfile), 0)
+        for (workdir, strip), patchfiles in by_workdir.items():
+            apply_git_patches(ctx, sorted(patchfiles), strip, workdir)
 
     def build(self, ctx: Context) -> None:
         if self.llvm_config is not None:
@@ -453,8 +592,38 @@ class LLVM(Package):
         # If necessary, apply the patches to the source tree first
         self.apply_patches(ctx)
 
-        # Go to the root directory and generate the build configuration/tree
-        self.goto_rootdir(ctx)
+        # Link with lld when it is available; it is considerably faster than BFD ld and
+        # cuts a large share of total build time for the many LLVM/clang link targets
+        linker_flags: list[str] = []
+        if shutil.which("ld.lld") is not None and not any(
+            flag.startswith("-DLLVM_USE_LINKER=") for flag in self.build_flags
+        ):
+            linker_flags = ["-DLLVM_USE_LINKER=lld"]
+
+        # Self-host with (Thin)LTO for Release builds where the host toolchain supports
+        # it (clang + ld.lld); an LTO'd clang compiles user code measurably faster
+        lto_flags: list[str] = []
+        if (
+            self.lto is not None
+            and "-DCMAKE_BUILD_TYPE=Release" in self.build_flags
+            and "clang" in os.path.basename(ctx.cc)
+            and shutil.which("ld.lld") is not None
+        ):
+            lto_flags = [f"-DLLVM_ENABLE_LTO={self.lto.capitalize()}"]
+
+        # Thread a compiler cache through CMake when one is available, so rebuilds
+        # after e.g. a patch tweak mostly hit cache instead of recompiling the tree
+        cache_flags: list[str] = []
+        if shutil.which("ccache") is not None:
+            cache_flags = ["-DLLVM_CCACHE_BUILD=ON"]
+        elif shutil.which("sccache") is not None:
+            cache_flags = [
+                "-DCMAKE_C_COMPILER_LAUNCHER=sccache",
+                "-DCMAKE_CXX_COMPILER_LAUNCHER=sccache",
+            ]
+
+        # Generate the build configuration/tree in the package's root directory
+        root_dir = self.path(ctx)
         run(
             ctx,
             [
@@ -470,14 +639,22 @@ class LLVM(Package):
                 f"-DLLVM_ENABLE_PROJECTS={';'.join(self.projects)}",
                 f"-DLLVM_ENABLE_RUNTIMES={';'.join(self.runtimes)}",
                 f"-DLLVM_PARALLEL_COMPILE_JOBS={ctx.jobs}",
-                f"-DLLVM_PARALLEL_LINK_JOBS={ctx.jobs}",
+                # Bound concurrent links: linking clang can take tens of GBs of RAM per job
+                f"-DLLVM_PARALLEL_LINK_JOBS={max(1, ctx.jobs // 8)}",
+                *linker_flags,
+                *lto_flags,
+                *cache_flags,
                 *self.build_flags,
             ],
             teeout=True,
+            cwd=root_dir,
         )
 
         # Actually run the build
-        run(ctx, ["cmake", "--build", "build", "--parallel", str(ctx.jobs)], teeout=True)
+        run(ctx, ["cmake", "--build", "build", "--parallel", str(ctx.jobs)], teeout=True, cwd=root_dir)
+
+        # Record what this build tree was produced from so is_built can detect staleness
+        self.root_dir(ctx, "build", ".infra-build-fingerprint").write_text(self._fingerprint(ctx))
 
     def install(self, ctx: Context) -> None:
         if self.llvm_config is not None:
@@ -489,7 +666,7 @@ class LLVM(Package):
             return
 
         # Install LLVM into the previously configured prefix
-        run(ctx, ["cmake", "--install", "build"], teeout=True)
+        run(ctx, ["cmake", "--install", "build"], teeout=True, cwd=self.path(ctx))
 
     def install_env(self, ctx: Context) -> None:
         # If LLVM was built locally, use the llvm-config installed by it; else use pre-existing llvm-config
@@ -4,6 +4,7 @@ import re
 import sys
 import shlex
 import shutil
+import hashlib
 import logging
 import threading
 import subprocess
@@ -15,7 +16,7 @@ from .context import Context
 
 from dataclasses import dataclass
 from urllib.parse import urlparse
-from urllib.request import urlretrieve
+from urllib.request import urlopen, urlretrieve
 from collections import OrderedDict
 from typing import (
     IO,
@@ -108,19 +109,22 @@ class FatalError(Exception):
     pass
 
 
-def apply_patch(ctx: Context, patch_path: Path | str, strip_count: int) -> bool:
+def apply_patch(ctx: Context, patch_path: Path | str, strip_count: int, cwd: Path | str | None = None) -> bool:
     """
-    Applies a patch in the current directory by calling ``patch -p<strip_count> < <path>``.
+    Applies a patch by calling ``patch -p<strip_count> < <path>`` in :param:`cwd` (or the current
+    directory if no working directory is given).
 
-    Afterwards, a stamp file called ``.patched-<basename>`` is created to indicate that the patch has
-    been applied. If the stamp file is already present, the patch is not applied at all, unless the
-    patch file from :param:`path` was modified after the creation date of the stamp file.
-    ``<basename`` is the final path component of the patch file with the .patch suffix removed:
-    ``path/to/my-patch.patch`` becomes `my-patch`.
+    Afterwards, a stamp file called ``.patched-<basename>`` is created that records the SHA-256 hash
+    of the patch file to indicate that the patch has been applied. If the stamp file is already
+    present and the recorded hash matches the current contents of the patch file, the patch is not
+    applied at all; this turns repeated builds of an already-patched tree into a single file read
+    instead of a full-tree scan by ``patch``. ``<basename`` is the final path component of the patch
+    file with the .patch suffix removed: ``path/to/my-patch.patch`` becomes `my-patch`.
 
     :param ctx: the configuration context
     :param path: path to the patch file
     :param strip_count: number of leading elements to strip from patch paths
+    :param cwd: working directory to apply the patch in, defaults to the current directory
     :returns: ``True`` if the patch was applied, ``False`` if it was already applied before
     """
     if isinstance(patch_path, str):
@@ -129,24 +133,135 @@ def apply_patch(ctx: Context, patch_path: Path | str, strip_count: int) -> bool:
         raise FileNotFoundError(f"Cannot apply patch; patch file not found: {patch_path}")
 
     # Stamp file is the final name component of the patch without the suffix
-    stamp_path = Path(f".patched-{patch_path.stem}")
+    workdir = Path(cwd) if cwd is not None else Path.cwd()
+    stamp_path = workdir / f".patched-{patch_path.stem}"
+    patch_hash = hashlib.sha256(patch_path.read_bytes()).hexdigest()
 
     # Check if the stamp exists
     if stamp_path.exists():
-        # Only exit now if the patch was applied after the patch file was modified last
-        patch_date = datetime.fromtimestamp(patch_path.stat().st_mtime)
-        stamp_date = datetime.fromtimestamp(stamp_path.stat().st_mtime)
-        if stamp_date > patch_date:
+        # Only exit now if the recorded hash matches the current patch contents
+        if stamp_path.read_text().strip() == patch_hash:
             ctx.log.info(f"Not applying patch; already applied {patch_path.stem}")
-            ctx.log.debug(f"Applied patch on {stamp_date}; patch last modified on {patch_date}")
+            ctx.log.debug(f"Recorded patch hash matches current contents: {patch_hash}")
             return False
 
+        # Legacy (empty) stamps carry no hash; fall back to mtime comparison
+        if not stamp_path.read_text().strip():
+            patch_date = datetime.fromtimestamp(patch_path.stat().st_mtime)
+            stamp_date = datetime.fromtimestamp(stamp_path.stat().st_mtime)
+            if stamp_date > patch_date:
+                ctx.log.info(f"Not applying patch; already applied {patch_path.stem}")
+                ctx.log.debug(f"Applied patch on {stamp_date}; patch last modified on {patch_date}")
+                return False
+
     ctx.log.debug(f"Applying patch {patch_path.stem}")
     require_program(ctx, "patch", "Required to apply source patches")
 
     with open(patch_path) as f:
-        run(ctx, f"patch -N -p{strip_count}", stdin=f, allow_error=True)
-    open(stamp_path, "w").close()
+        run(ctx, f"patch -N -p{strip_count}", stdin=f, allow_error=True, cwd=workdir)
+    stamp_path.write_text(patch_hash)
+
+    return True
+
+
+def apply_git_patches(
+    ctx: Context,
+    patch_paths: Iterable[Path | str],
+    strip_count: int,
+    cwd: Path | str,
+) -> bool:
+    """
+    Apply multiple patches to a git-managed source tree with a single ``git apply --3way``
+    invocation, instead of forking one ``patch`` process (and scanning the tree) per file.
+
+    Uses the same ``.patched-<basename>`` stamp files as :func:`apply_patch`, so patches that
+    were already applied (by either function) are filtered out before invoking git. A patch
+    without a stamp whose changes are nonetheless present in the tree (stamps wiped, or the
+    patch merged upstream in the pinned commit) is detected with ``git apply --check
+    --reverse`` and skipped with a warning, as is a patch that does not apply at all (e.g. a
+    strip-count mismatch: git-style ``a/``/``b/`` prefixes need ``-p1``). Pending patches
+    are validated cumulatively, in the given order, so that series where later patches
+    depend on earlier ones still apply. Stamps are written for all applied patches
+    afterwards; because the batch is applied atomically, either all pending patches apply
+    or none do.
+
+    :param ctx: the configuration context
+    :param patch_paths: paths to the patch files to apply
+    :param strip_count: number of leading elements to strip from patch paths
+    :param cwd: root of the git-managed tree to patch
+    :returns: ``True`` if any patch was applied, ``False`` if all were already applied before
+    """
+    workdir = Path(cwd)
+    require_program(ctx, "git", "Required to batch-apply patches to git source trees")
+
+    pending: list[tuple[Path, Path, str]] = []
+    for patch_path in patch_paths:
+        # Absolute paths, since git runs with the tree to patch as working directory
+        patch_path = Path(patch_path).absolute()
+        if not patch_path.exists():
+            raise FileNotFoundError(f"Cannot apply patch; patch file not found: {patch_path}")
+
+        stamp_path = workdir / f".patched-{patch_path.stem}"
+        patch_hash = hashlib.sha256(patch_path.read_bytes()).hexdigest()
+
+        # Skip patches recorded as applied; legacy (empty) stamps are also trusted here
+        if stamp_path.exists() and stamp_path.read_text().strip() in (patch_hash, ""):
+            ctx.log.info(f"Not applying patch; already applied {patch_path.stem}")
+            continue
+
+        pending.append((patch_path, stamp_path, patch_hash))
+
+    if not pending:
+        return False
+
+    # git apply only evaluates a series cumulatively (building the result in-core) when
+    # it arrives as one patch stream; passed as separate file arguments, --check tests
+    # every patch against the unpatched tree and ordered series where later patches
+    # build on earlier ones spuriously fail
+    def check_series(series: list[tuple[Path, Path, str]]) -> bool:
+        stream = "".join(path.read_text() for path, _, _ in series)
+        cmd = ["git", "apply", "--check", f"-p{strip_count}"]
+        return run(ctx, cmd, allow_error=True, silent=True, cwd=workdir, input=stream).returncode == 0
+
+    # Validate the pending batch before applying: a patch whose changes are already in
+    # the tree, or one that doesn't apply at all, must not abort the whole run
+    if check_series(pending):
+        appliable = pending
+    else:
+        # Something in the batch doesn't fit; triage patch by patch, each on top of the
+        # preceding patches that did pass, to skip only the offenders
+        appliable = []
+        for patch_path, stamp_path, patch_hash in pending:
+            if check_series(appliable + [(patch_path, stamp_path, patch_hash)]):
+                appliable.append((patch_path, stamp_path, patch_hash))
+                continue
+
+            reverse = ["git", "apply", "--check", "--reverse", f"-p{strip_count}", str(patch_path)]
+            if run(ctx, reverse, allow_error=True, silent=True, cwd=workdir).returncode == 0:
+                ctx.log.warning(f"patch {patch_path.stem} is already present in the tree; recording its stamp")
+                stamp_path.write_text(patch_hash)
+                continue
+
+            ctx.log.warning(
+                f"skipping patch {patch_path.stem}: does not apply on top of the preceding "
+                f"patches (it may depend on a patch that was skipped or failed earlier, or "
+                f"need a different strip count: git-style a/ b/ path prefixes need -p1)"
+            )
+
+    if not appliable:
+        return False
+
+    names = ", ".join(path.stem for path, _, _ in appliable)
+    ctx.log.debug(f"Applying {len(appliable)} patch(es) with a single git apply invocation: {names}")
+    run(
+        ctx,
+        ["git", "apply", "--3way", f"-p{strip_count}"],
+        cwd=workdir,
+        input="".join(path.read_text() for path, _, _ in appliable),
+    )
+
+    for _, stamp_path, patch_hash in appliable:
+        stamp_path.write_text(patch_hash)
 
     return True
 
@@ -567,7 +682,8 @@ def run(
     """
     cmd_list = get_cmd_list(raw_cmd=cmd)
     cmd_str = get_safe_cmd_str(cmd_list, kwargs.get("stdin", None))
-    ctx.log.info(f"Running command: {cmd_str} (working dir: {os.getcwd()})")
+    workdir = str(kwargs.get("cwd") or os.getcwd())
+    ctx.log.info(f"Running command: {cmd_str} (working dir: {workdir})")
     assert cmd_list is not None
 
     # Start the local environment with the current running environment and the stored C/C++/etc compilers
@@ -601,7 +717,7 @@ def run(
         ctx.runlog_file.write(f"{'-' * 100}\n")
         ctx.runlog_file.write(f"Running command:   '{cmd_str}'\n")
         ctx.runlog_file.write(f"Unquoted command:  '{' '.join(cmd_list)}'\n")
-        ctx.runlog_file.write(f"Working directory: '{os.getcwd()}'\n")
+        ctx.runlog_file.write(f"Working directory: '{workdir}'\n")
         ctx.runlog_file.write("Local environment: ")
         ctx.runlog_file.write("{\n" if len(run_env) > 0 else "{")
         ctx.runlog_file.write("\n".join([f"\t{key}={val}" for key, val in sorted(run_env.items(), key=lambda item: item[0])]))
@@ -664,7 +780,7 @@ def run(
         (ctx.log.error if allow_error else ctx.log.critical)(
             f"Running command:   '{cmd_str}'\n"
             + f"Unquoted command:  '{' '.join(cmd_list)}'\n"
-            + f"Working directory: '{os.getcwd()}'\n"
+            + f"Working directory: '{workdir}'\n"
             + "Local environment: {"
             + "\n".join([f"\t{key}={val}" for key, val in run_env.items()])
             + "}"
@@ -695,7 +811,7 @@ def run(
         ctx.log.critical(
             f"Return code:       {proc.returncode}\n"
             + f"Executed command:  {cmd_str}\n"
-            + f"Working directory: {os.getcwd()}\n"
+            + f"Working directory: {workdir}\n"
             + "Local environment: {\n\t"
             + "\n\t".join([f"\t{key}={val}" for key, val in run_env.items()])
             + "\n}"
@@ -720,6 +836,15 @@ def download(ctx: Context, url: str, outfile: str | None = None) -> str:
     """
     Download a file (logs to the debug log).
 
+    When ``aria2c`` is available, the file is downloaded over multiple
+    parallel HTTP range requests, which typically saturates link bandwidth
+    on large (multi-hundred-MB) release artifacts where a single TCP stream
+    would not. ``curl`` is the next preference; both resume partial
+    downloads left by an earlier failed attempt (via ``Range:``
+    continuation) instead of re-transferring the whole file, and retry on
+    transient network errors. A plain non-resumable download is the last
+    resort.
+
     :param ctx: the configuration context
     :param url: URL to the file to download
     :param outfile: optional path/filename to download to
@@ -732,12 +857,169 @@ def download(ctx: Context, url: str, outfile: str | None = None) -> str:
         ctx.log.debug(f"downloading {url}")
 
     if os.path.exists(outfile):
-        ctx.log.warning(f"overwriting existing outfile: {outfile}")
+        ctx.log.warning(f"resuming/overwriting existing outfile: {outfile}")
+
+    if shutil.which("aria2c") is not None:
+        proc = run(
+            ctx,
+            [
+                "aria2c",
+                "-c",
+                "-x", "8",
+                "-s", "8",
+                "-k", "1M",
+                "--auto-file-renaming=false",
+                "--allow-overwrite=true",
+                "-d", os.path.dirname(os.path.abspath(outfile)),
+                "-o", os.path.basename(outfile),
+                url,
+            ],
+            allow_error=True,
+        )
+        if proc.returncode == 0 and os.path.exists(outfile):
+            return outfile
+        ctx.log.warning(f"aria2c failed to download {url}; falling back to curl")
+
+    if shutil.which("curl") is not None:
+        proc = run(
+            ctx,
+            [
+                "curl",
+                "-fL",
+                "-C", "-",
+                "--retry", "10",
+                "--retry-delay", "2",
+                "-o", outfile,
+                url,
+            ],
+            allow_error=True,
+        )
+        if proc.returncode == 0 and os.path.exists(outfile):
+            return outfile
+        ctx.log.warning(f"curl failed to download {url}; falling back to single-stream download")
 
     urlretrieve(url, outfile)
     return outfile
 
 
+def move_tree(ctx: Context, src: str, dst: str) -> None:
+    """
+    Move a directory tree, avoiding byte-by-byte copies where possible.
+
+    On the same filesystem this is a plain rename (like :func:`shutil.move`).
+    Across filesystems -- e.g. when sources are extracted on a scratch/tmpfs
+    mount or a different btrfs subvolume than the build tree --
+    :func:`shutil.move` degrades to a full copy of every file; in that case
+    this helper first tries ``cp -r --reflink=auto``, which on CoW
+    filesystems shares data extents and makes the move O(metadata) instead
+    of O(bytes), before falling back to a regular copy.
+
+    :param ctx: the configuration context
+    :param src: directory tree to move
+    :param dst: destination path
+    """
+    dst_parent = os.path.dirname(os.path.abspath(dst)) or "."
+    if os.stat(src).st_dev == os.stat(dst_parent).st_dev:
+        shutil.move(src, dst)
+        return
+
+    ctx.log.debug(f"moving {src} to {dst} across filesystems")
+    if shutil.which("cp") is not None:
+        # -a preserves timestamps and modes: freshly extracted autotools trees with
+        # scrambled mtimes can otherwise trigger spurious maintainer-mode regeneration
+        proc = run(ctx, ["cp", "-a", "--reflink=auto", src, dst], allow_error=True)
+        if proc.returncode == 0:
+            shutil.rmtree(src)
+            return
+        ctx.log.warning(f"cp --reflink=auto failed for {src}; falling back to regular copy")
+
+        # Remove whatever the failed cp left behind: shutil.move would otherwise move
+        # src *inside* the partially-populated existing dst instead of replacing it
+        if os.path.exists(dst):
+            shutil.rmtree(dst)
+
+    shutil.move(src, dst)
+
+
+def download_and_extract(
+    ctx: Context,
+    url: str,
+    dest: str | None = None,
+    *,
+    basename: str | None = None,
+) -> None:
+    """
+    Download an archive and stream it straight into ``tar``, without ever
+    materialising the compressed archive on disk. Compared to
+    :func:`download` followed by :func:`untar` this halves disk writes (the
+    archive is never written, read back, and deleted again) and keeps the
+    working set in page cache, which matters for multi-hundred-MB source
+    tarballs.
+
+    Like :func:`untar`, decompression runs in parallel when a suitable
+    program is available.
+
+    :param ctx: the configuration context
+    :param url: URL of the archive to download and extract
+    :param dest: directory holding extracted archive contents, defaults to None
+    :param basename: name of output directory, defaults to archive name without .tar.*
+    """
+    require_program(ctx, "tar", "required to unpack source tarfile")
+
+    tarname = os.path.basename(urlparse(url).path)
+    if basename is None:
+        basename = re.sub(r"\.tar(\.\w+)?", "", tarname)
+
+    cmd = ["tar", "-xf", "-"]
+    if (decompressor := _parallel_decompressor(tarname)) is not None:
+        cmd.insert(1, f"--use-compress-program={decompressor}")
+
+    ctx.log.debug(f"downloading {url} and extracting (output directory basename: {basename})")
+    with urlopen(url) as response:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        assert proc.stdin is not None
+        shutil.copyfileobj(response, proc.stdin, length=1024 * 1024)
+        proc.stdin.close()
+        if proc.wait() != 0:
+            raise FatalError(f"tar returned {proc.returncode} while extracting stream from {url}")
+
+    if dest:
+        ctx.log.debug(f"Moving output directory {basename} to {dest}")
+        move_tree(ctx, basename, dest)
+
+
+def git_mirror(ctx: Context, url: str) -> str:
+    """
+    Maintain a local bare mirror of a git repository under
+    ``~/.cache/infra/git-mirrors/`` and return its path.
+
+    On first use the repository is cloned with ``git clone --mirror``; on
+    subsequent uses the mirror is refreshed with ``git remote update --prune``.
+    The returned path can be passed to ``git clone --reference-if-able
+    <mirror> --dissociate`` so that repeated fetches of the same upstream
+    (e.g. after a forced rebuild, or for multiple package versions) reuse the
+    locally cached objects instead of re-downloading them.
+
+    :param ctx: the configuration context
+    :param url: URL of the upstream git repository
+    :returns: absolute path to the local bare mirror
+    """
+    require_program(ctx, "git", "required to mirror git repositories")
+
+    mirror_root = os.path.join(os.path.expanduser("~"), ".cache", "infra", "git-mirrors")
+    mirror = os.path.join(mirror_root, hashlib.sha1(url.encode()).hexdigest() + ".git")
+    os.makedirs(mirror_root, exist_ok=True)
+
+    if not os.path.exists(mirror):
+        ctx.log.debug(f"creating git mirror of {url} at {mirror}")
+        run(ctx, ["git", "clone", "--mirror", url, mirror])
+    else:
+        ctx.log.debug(f"updating git mirror of {url} at {mirror}")
+        run(ctx, ["git", "-C", mirror, "remote", "update", "--prune"])
+
+    return mirror
+
+
 class _Tee(io.IOBase):
     """
     Extension of io.IOBase to split output over multiple given writers (other IOBases,
@@ -855,6 +1137,33 @@ class _Tee(io.IOBase):
                     break
 
 
+#: Memoized results of :func:`cached_exists` probes.
+_exists_cache: dict[str, bool] = {}
+
+
+def cached_exists(path: str) -> bool:
+    """
+    Memoized :func:`os.path.exists`. The ``is_fetched``/``is_built``/``is_installed``
+    probes run for every package in the dependency graph, often several times per
+    command, and each ``exists`` call stats every path component; caching the results
+    avoids that stat storm on large graphs.
+
+    Callers that create or remove probed files (fetch/build/install steps) must call
+    :func:`clear_exists_cache` afterwards so stale negatives don't stick around.
+
+    :param path: (absolute) path to check for existence
+    :returns: whether the path exists
+    """
+    if path not in _exists_cache:
+        _exists_cache[path] = os.path.exists(path)
+    return _exists_cache[path]
+
+
+def clear_exists_cache() -> None:
+    """Invalidate all results memoized by :func:`cached_exists`."""
+    _exists_cache.clear()
+
+
 def require_program(ctx: Context, name: str, error: str | None = None) -> None:
     """
     Require a program to be available in ``PATH`` or ``ctx.runenv.PATH``.
@@ -872,6 +1181,31 @@ def require_program(ctx: Context, name: str, error: str | None = None) -> None:
         raise FatalError(f"'{name}' not found in PATH ({error if error else ''}): {path}")
 
 
+def _parallel_decompressor(tarname: str) -> str | None:
+    """
+    Find a parallel decompression command for the given archive name, to pass
+    to ``tar --use-compress-program``. Returns ``None`` if no suitable program
+    is available, in which case tar should fall back to its built-in
+    (single-threaded) decompression.
+
+    :param tarname: name/path of the archive to decompress
+    :returns: decompression command, or ``None`` for the tar default
+    """
+    if tarname.endswith((".tar.xz", ".txz")):
+        for prog in ("pixz", "pxz"):
+            if shutil.which(prog):
+                return f"{prog} -d"
+        if shutil.which("xz"):
+            return "xz -T0 -d"
+    elif tarname.endswith((".tar.gz", ".tgz")):
+        if shutil.which("pigz"):
+            return "pigz -d"
+    elif tarname.endswith(".tar.bz2"):
+        if shutil.which("pbzip2"):
+            return "pbzip2 -d"
+    return None
+
+
 def untar(
     ctx: Context,
     tarname: str,
@@ -884,6 +1218,10 @@ def untar(
     Extract a given archive using `tar -xf`. Optionally deletes the archive
     after extracting and renames the extracted directory.
 
+    Decompression runs in parallel across cores where possible (e.g. through
+    ``pigz`` or ``xz -T0``), since single-threaded decompression dominates
+    extraction time for large archives.
+
     :param ctx: the configuration context
     :param tarname: name/path of the archive to extract
     :param dest: directory holding extracted archive contents, defaults to None
@@ -896,11 +1234,14 @@ def untar(
         basename = re.sub(r"\.tar(\.\w+)?", "", tarname)
 
     ctx.log.debug(f"Extracting {tarname} (output directory basename: {basename})")
-    run(ctx, ["tar", "-xf", tarname])
+    if (decompressor := _parallel_decompressor(tarname)) is not None:
+        run(ctx, ["tar", f"--use-compress-program={decompressor}", "-xf", tarname])
+    else:
+        run(ctx, ["tar", "-xf", tarname])
 
     if dest:
         ctx.log.debug(f"Moving output directory {basename} to {dest}")
-        shutil.move(basename, dest)
+        move_tree(ctx, basename, dest)
     if remove:
         ctx.log.debug(f"Deleting original archive {tarname}")
         os.remove(tarname)